@@ -1,15 +1,24 @@
-from fastapi import FastAPI, UploadFile, Form
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from uuid import uuid4
+from secrets import token_hex, token_urlsafe
 from pathlib import Path
-import json, shutil, subprocess, os
+from typing import Optional
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import asyncio, shutil, os
+import aiofiles
 import httpx
+import orjson
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
 
 app = FastAPI()
 
-BASE_DIR = Path(__file__).parent
+BASE_DIR = Path(__file__).resolve().parent
 SESS_BASE = BASE_DIR / "sessions"
 SESS_BASE.mkdir(exist_ok=True)
 
@@ -22,27 +31,53 @@ def root():
 
 # ---------- 설정: 판단 서버 주소 ----------
 JUDGE_BASE_URL = os.getenv("JUDGE_BASE_URL", "http://127.0.0.1:9000")
-JUDGE_INGEST_CHUNK = f"{JUDGE_BASE_URL}/ingest-chunk"
-JUDGE_INGEST_FINAL = f"{JUDGE_BASE_URL}/ingest-final"
+
+# 판단 서버와의 연결을 재사용 (연결 풀 keep-alive)
+# 연결 단계 실패는 transport에서 1회 재시도
+JUDGE = httpx.AsyncClient(
+    base_url=JUDGE_BASE_URL,
+    timeout=10.0,
+    transport=httpx.AsyncHTTPTransport(
+        retries=1,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    ),
+)
+# 동시에 나가는 판단 서버 요청 수 제한 (버스트 시 판단 서버 대기열을 얕게 유지)
+JUDGE_SEM = asyncio.Semaphore(32)
+# 조각별 ffmpeg 디코드 동시 실행 수를 프로세스 전체에서 코어 수로 제한 (세션 수와 무관)
+FFMPEG_SEM = asyncio.Semaphore(os.cpu_count() or 1)
+
+@app.on_event("shutdown")
+async def close_judge_client():
+    await JUDGE.aclose()
 
 # ---------- ffmpeg 탐색/호출 ----------
 def resolve_ffmpeg():
     env_path = os.getenv("FFMPEG_PATH")
     if env_path and Path(env_path).exists():
-        return env_path
+        return os.path.abspath(env_path)
     found = shutil.which("ffmpeg")
     if found:
-        return found
+        return os.path.abspath(found)
     return None
 
 FFMPEG = resolve_ffmpeg()
+# 모든 호출에 공통인 인자는 한 번만 만들어 둠 (-nostdin: 터미널 입력 대기 방지)
+FFMPEG_PREFIX = (FFMPEG, "-hide_banner", "-loglevel", "error", "-nostdin") if FFMPEG else None
 
-def run_ffmpeg(args: list):
-    if not FFMPEG:
+# ffmpeg을 기다리는 동안 이벤트 루프가 다른 요청을 처리하도록 비동기 실행
+async def run_ffmpeg_async(args: list, input: Optional[bytes] = None):
+    if not FFMPEG_PREFIX:
         raise RuntimeError("ffmpeg not found. Install it or set FFMPEG_PATH.")
-    proc = subprocess.run([FFMPEG] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    proc = await asyncio.create_subprocess_exec(
+        *FFMPEG_PREFIX, *args,
+        stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, err = await proc.communicate(input)
     if proc.returncode != 0:
-        raise RuntimeError(f"ffmpeg failed ({proc.returncode}):\n{proc.stderr}")
+        raise RuntimeError(f"ffmpeg failed ({proc.returncode}):\n{err.decode(errors='replace')}")
     return proc
 
 # ---------- 모델 ----------
@@ -58,22 +93,109 @@ def sess_dir(sid: str) -> Path:
 def meta_path(sid: str) -> Path:
     return sess_dir(sid) / "meta.json"
 
+def chunk_name(seq: int, ext: str) -> str:
+    # 0 패딩: 사전순 정렬 = seq 순서 (외부 도구용)
+    return f"{seq:06d}.{ext}"
+
+def scan_chunks(sid: str) -> list:
+    # 캐시가 없을 때(재시작 등)만 디렉터리를 한 번 훑어 조각 목록 복원
+    chunks = []
+    for p in sess_dir(sid).iterdir():
+        if p.suffix.lower() in (".ogg", ".webm") and p.stem.isdecimal():
+            chunks.append([int(p.stem), p.name])
+    chunks.sort()
+    return chunks
+
+def add_chunk(meta: dict, seq: int, name: str):
+    # [seq, 파일명]을 seq 순서로 유지 (같은 seq 재전송은 교체)
+    chunks = meta["chunks"]
+    i = bisect_left(chunks, [seq])
+    if i < len(chunks) and chunks[i][0] == seq:
+        chunks[i] = [seq, name]
+    else:
+        chunks.insert(i, [seq, name])
+
+# 세션 메타는 메모리에 두고, 상태가 바뀔 때만 meta.json에 기록
+# (조각 목록 "chunks"는 메모리 전용)
+# 캐시는 최근 세션 META_CACHE_MAX개만 유지: 빠진 세션은 meta.json + scan_chunks로 복원
+META_CACHE_MAX = 1024
+META_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+# 세션 락은 사용 중인 동안만 보관: sid -> [lock, 사용자 수]
+META_LOCKS: dict[str, list] = {}
+
+@asynccontextmanager
+async def session_lock(sid: str):
+    entry = META_LOCKS.setdefault(sid, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del META_LOCKS[sid]
+
+def cache_meta(sid: str, meta: dict):
+    META_CACHE[sid] = meta
+    META_CACHE.move_to_end(sid)
+    while len(META_CACHE) > META_CACHE_MAX:
+        META_CACHE.popitem(last=False)
+
+def evict_meta(sid: str):
+    META_CACHE.pop(sid, None)
+
 def load_meta(sid: str) -> dict:
+    meta = META_CACHE.get(sid)
+    if meta is not None:
+        META_CACHE.move_to_end(sid)
+        return meta
     p = meta_path(sid)
     if p.exists():
-        return json.loads(p.read_text(encoding="utf-8"))
-    return {"state": "waiting", "start_seq": None, "end_seq": None}
+        meta = orjson.loads(p.read_bytes())
+    else:
+        meta = {"state": "waiting", "start_seq": None, "end_seq": None}
+    meta["chunks"] = scan_chunks(sid)
+    cache_meta(sid, meta)
+    return meta
 
 def save_meta(sid: str, meta: dict):
-    meta_path(sid).write_text(json.dumps(meta), encoding="utf-8")
+    cache_meta(sid, meta)
+    p = meta_path(sid)
+    tmp = p.with_suffix(".json.tmp")
+    tmp.write_bytes(orjson.dumps({k: v for k, v in meta.items() if k != "chunks"}))
+    os.replace(tmp, p)
+
+# multipart 파일 파트를 임시 파일 없이 곧바로 디스크에 기록
+class ChunkTarget(BaseTarget):
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = path
+        self.received = False
+        self._f = None
+
+    def on_start(self):
+        self._f = self.path.open("wb", buffering=1 << 20)
+        self.received = True
+
+    def on_data_received(self, chunk: bytes):
+        self._f.write(chunk)
+
+    def on_finish(self):
+        self.close()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
 
 # 판단 서버 호출: 조각 전달 → start/end 또는 continue
-def send_to_judge(session_id: str, seq: str, container: str, filepath: Path) -> str:
+async def send_to_judge(session_id: str, seq: int, container: str, filepath: Path) -> str:
     try:
         with filepath.open("rb") as f:
             files = {"chunk": (filepath.name, f, f"audio/{container}")}
             data = {"sessionId": session_id, "seq": seq, "container": container}
-            resp = httpx.post(JUDGE_INGEST_CHUNK, data=data, files=files, timeout=10.0)
+            async with JUDGE_SEM:
+                resp = await JUDGE.post("/ingest-chunk", data=data, files=files)
 
         if resp.status_code == 204:
             return "continue"
@@ -86,19 +208,97 @@ def send_to_judge(session_id: str, seq: str, container: str, filepath: Path) ->
     except Exception:
         return "continue"
 
+# multipart 본문을 직접 구성: 파일 파트는 1MB씩 읽어 그대로 흘려보냄
+def multipart_file_body(fields: dict, name: str, path: Path, content_type: str):
+    boundary = os.urandom(16).hex()
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+        for k, v in fields.items()
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{path.name}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def stream():
+        yield head
+        async with aiofiles.open(path, "rb") as f:
+            while chunk := await f.read(1 << 20):
+                yield chunk
+        yield tail
+
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + path.stat().st_size + len(tail)),
+    }
+    return headers, stream()
+
 # 완성 파일을 판단 서버로 전달
-def send_final_to_judge(session_id: str, final_path: Path) -> bool:
+async def send_final_to_judge(session_id: str, final_path: Path) -> bool:
     try:
-        with final_path.open("rb") as f:
-            files = {"final": (final_path.name, f, "audio/wav")}
-            data = {"sessionId": session_id}
-            resp = httpx.post(JUDGE_INGEST_FINAL, data=data, files=files, timeout=20.0)
-            return resp.status_code in (200, 201)
+        headers, body = multipart_file_body({"sessionId": session_id}, "final", final_path, "audio/wav")
+        async with JUDGE_SEM:
+            resp = await JUDGE.post("/ingest-final", content=body, headers=headers, timeout=20.0)
+        return resp.status_code in (200, 201)
     except Exception:
         return False
 
+# 다시 읽지 않을 파일은 페이지 캐시에서 내려보냄 (posix_fadvise가 있는 경우만)
+def drop_page_cache(paths: list):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for p in paths:
+        try:
+            fd = os.open(p, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+# concat demuxer 목록: 파일로 쓰지 않고 ffmpeg stdin(pipe:0)으로 전달
+# ffmpeg은 항목을 목록 URL(pipe:) 기준으로 해석하므로 절대경로라도 "file:"을 명시해야 함
+CONCAT_INPUT = ["-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", "pipe:0"]
+
+def concat_list(files: list) -> bytes:
+    return "".join(f"file 'file:{p.as_posix()}'\n" for p in files).encode("utf-8")
+
+# 조각별 디코드 (단일 패스가 실패했을 때만 사용): 깨진 조각은 건너뜀
+async def decode_part(p: Path, w: Path) -> Path:
+    if not w.exists():
+        async with FFMPEG_SEM:
+            await run_ffmpeg_async([
+                "-threads", "1",
+                "-fflags", "+genpts",
+                "-y", "-i", str(p),
+                "-ac", "1", "-ar", "16000",
+                str(w)
+            ])
+    return w
+
+async def decode_parts(parts: list, wav_dir: Path) -> tuple[list, list]:
+    wav_dir.mkdir(exist_ok=True)
+    skipped = []
+    converted = []
+
+    # ffmpeg 프로세스마다 스레드 1개, 동시 실행 수는 FFMPEG_SEM이 제한
+    results = await asyncio.gather(
+        *(decode_part(p, wav_dir / (p.stem + ".wav")) for p in parts),
+        return_exceptions=True,
+    )
+    # gather는 조각 순서를 유지
+    for p, r in zip(parts, results):
+        if isinstance(r, Exception):
+            skipped.append([p.name, str(r)])
+        else:
+            converted.append(r)
+
+    return converted, skipped
+
 # 병합: start~end 조각을 WAV로 합쳐 Path 반환
-def build_final_wav(session_id: str) -> tuple[Path, list]:
+async def build_final_wav(session_id: str) -> tuple[Path, list]:
     d = sess_dir(session_id)
     meta = load_meta(session_id)
     if meta["start_seq"] is None or meta["end_seq"] is None:
@@ -106,114 +306,145 @@ def build_final_wav(session_id: str) -> tuple[Path, list]:
 
     start_seq, end_seq = meta["start_seq"], meta["end_seq"]
 
-    parts = []
-    for p in sorted(d.iterdir()):
-        if p.suffix.lower() in (".ogg", ".webm"):
-            if start_seq <= p.stem <= end_seq:
-                parts.append(p)
+    parts = [d / name for s, name in meta["chunks"] if start_seq <= s <= end_seq]
     if not parts:
         raise RuntimeError("no chunks in selected range")
 
-    wav_dir = d / "wav"
-    wav_dir.mkdir(exist_ok=True)
-    skipped = []
-    converted = []
+    out_wav = d / "final.wav"
 
-    for p in parts:
-        w = wav_dir / (p.stem + ".wav")
-        if w.exists():
-            converted.append(w)
-            continue
+    # 같은 컨테이너끼리면 원본 조각들을 ffmpeg 한 번으로 디코드+병합 (디코드 1회)
+    # ogg/webm이 섞인 세션은 concat demuxer로 이어붙일 수 없으므로 바로 조각별 디코드
+    if all(p.suffix == parts[0].suffix for p in parts):
         try:
-            run_ffmpeg([
-                "-hide_banner", "-loglevel", "error",
+            await run_ffmpeg_async([
                 "-fflags", "+genpts",
-                "-y", "-i", str(p),
-                "-ac", "1", "-ar", "16000",
-                str(w)
-            ])
-            converted.append(w)
-        except Exception as ee:
-            skipped.append((p.name, str(ee)))
-
+                "-y", *CONCAT_INPUT,
+                "-ac", "1", "-ar", "16000", "-c:a", "pcm_s16le",
+                str(out_wav)
+            ], input=concat_list(parts))
+            drop_page_cache(parts)
+            return out_wav, []
+        except RuntimeError:
+            pass
+
+    # 불완전한 조각이나 컨테이너가 섞여 있으면 조각별로 디코드해서 읽히는 것만 병합
+    converted, skipped = await decode_parts(parts, d / "wav")
     if not converted:
         raise RuntimeError("no chunk could be decoded; prefer Ogg/Opus or ensure full WebM fragments.")
 
-    concat_txt = d / "concat.txt"
-    with concat_txt.open("w", encoding="utf-8") as f:
-        for w in sorted(converted, key=lambda x: x.stem):
-            if start_seq <= w.stem <= end_seq:
-                f.write(f"file '{w.as_posix()}'\n")
-
-    out_wav = d / "final.wav"
-    run_ffmpeg([
-        "-hide_banner", "-loglevel", "error",
-        "-y", "-f", "concat", "-safe", "0",
-        "-i", str(concat_txt),
+    await run_ffmpeg_async([
+        "-y", *CONCAT_INPUT,
         "-c", "copy",
         str(out_wav)
-    ])
+    ], input=concat_list(converted))
+    drop_page_cache(parts + converted)
 
     return out_wav, skipped
 
 # ---------- 라우트 ----------
 @app.post("/start")
 def start():
-    sid = str(uuid4())
-    save_meta(sid, {"state": "waiting", "start_seq": None, "end_seq": None})
+    sid = token_urlsafe(16)
+    save_meta(sid, {"state": "waiting", "start_seq": None, "end_seq": None, "chunks": []})
     return {"sessionId": sid}
 
 @app.post("/upload-chunk")
-async def upload_chunk(
-    sessionId: str = Form(...),
-    seq: str = Form(...),
-    chunk: UploadFile = Form(...),
-    container: str = Form("ogg"),   # "ogg" or "webm"
-):
+async def upload_chunk(request: Request):
+    # 폼 필드: sessionId, seq, chunk, container("ogg" or "webm")
+    # 세션/seq는 파일 파트 뒤에 올 수도 있으므로 일단 임시 경로에 기록 후 rename
+    tmp_path = SESS_BASE / f".incoming-{token_hex(16)}.part"
+    target = ChunkTarget(tmp_path)
+    fields = {name: ValueTarget() for name in ("sessionId", "seq", "container")}
     try:
+        try:
+            parser = StreamingFormDataParser(headers=request.headers)
+            parser.register("chunk", target)
+            for name, t in fields.items():
+                parser.register(name, t)
+            async for data in request.stream():
+                parser.data_received(data)
+        except ParseFailedException as e:
+            # multipart가 아니거나 본문 구성이 깨진 요청은 Form(...) 검증처럼 클라이언트 오류로 처리
+            return JSONResponse({"error": "bad_request", "detail": str(e)}, status_code=422)
+        target.close()
+
+        sessionId = fields["sessionId"].value.decode()
+        seq = fields["seq"].value.decode()
+        container = fields["container"].value.decode() or "ogg"
+        if not sessionId or not seq.isdecimal() or not target.received:
+            return JSONResponse(
+                {"error": "bad_request", "detail": "sessionId, integer seq and chunk are required"},
+                status_code=422,
+            )
+        seq = int(seq)
+
         d = sess_dir(sessionId)
         ext = "ogg" if container == "ogg" else "webm"
-        out_path = d / f"{seq}.{ext}"
-        with out_path.open("wb") as f:
-            shutil.copyfileobj(chunk.file, f)
-
-        meta = load_meta(sessionId)
-        if meta["state"] == "ended":
-            return {"decision": "continue"}
-
-        decision = send_to_judge(sessionId, seq, ext, out_path)
-
-        if decision == "start" and meta["state"] == "waiting":
-            meta["state"] = "recording"
-            meta["start_seq"] = seq
-            save_meta(sessionId, meta)
-
-        elif decision == "end":
-            meta["state"] = "ended"
-            meta["end_seq"] = seq
-            save_meta(sessionId, meta)
-
-            # 병합 → 판단 서버에 최종 파일 전송
-            final_path, skipped = build_final_wav(sessionId)
-            ok = send_final_to_judge(sessionId, final_path)
-            return {"decision": "end", "finalSent": ok, "skipped": skipped}
-
-        return {"decision": decision}
+        out_path = d / chunk_name(seq, ext)
+        os.replace(tmp_path, out_path)
+
+        # 같은 세션의 조각이 동시에 와도 상태 전이가 꼬이지 않도록
+        async with session_lock(sessionId):
+            meta = load_meta(sessionId)
+            add_chunk(meta, seq, out_path.name)
+            if meta["state"] == "ended":
+                return {"decision": "continue"}
+
+            decision = await send_to_judge(sessionId, seq, ext, out_path)
+            drop_page_cache([out_path])
+
+            if decision == "start" and meta["state"] == "waiting":
+                meta["state"] = "recording"
+                meta["start_seq"] = seq
+                save_meta(sessionId, meta)
+
+            elif decision == "end":
+                meta["state"] = "ended"
+                meta["end_seq"] = seq
+                save_meta(sessionId, meta)
+
+                # 병합 → 판단 서버에 최종 파일 전송
+                final_path, skipped = await build_final_wav(sessionId)
+                ok = await send_final_to_judge(sessionId, final_path)
+                # 끝난 세션은 더 갱신되지 않으므로 캐시에서 내림
+                evict_meta(sessionId)
+                return {"decision": "end", "finalSent": ok, "skipped": skipped}
+
+            return {"decision": decision}
 
     except Exception as e:
         return JSONResponse({"error": "upload_failed", "detail": str(e)}, status_code=500)
+    finally:
+        target.close()
+        tmp_path.unlink(missing_ok=True)
 
 @app.post("/finalize")
-def finalize(req: FinalizeReq):
+async def finalize(req: FinalizeReq):
     try:
-        final_path, skipped = build_final_wav(req.sessionId)
+        # upload-chunk의 end 처리나 다른 finalize와 final.wav를 동시에 만들지 않도록
+        async with session_lock(req.sessionId):
+            final_path, skipped = await build_final_wav(req.sessionId)
         return {"fileUrl": f"/download/{req.sessionId}", "skipped": skipped}
     except Exception as e:
         return JSONResponse({"error": "ffmpeg_failed", "detail": str(e)}, status_code=500)
 
 @app.get("/download/{session_id}")
-def download(session_id: str):
+def download(session_id: str, request: Request):
     out_wav = sess_dir(session_id) / "final.wav"
-    if not out_wav.exists():
+    try:
+        st = out_wav.stat()
+    except FileNotFoundError:
         return JSONResponse({"error": "not ready"}, status_code=404)
-    return FileResponse(str(out_wav), media_type="audio/wav", filename="final.wav")
\ No newline at end of file
+
+    # 같은 파일이면 304로 끝냄, 아니면 stat 결과를 넘겨 재stat 없이 전송 (Range 지원)
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match == "*" or etag in (t.strip() for t in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FileResponse(
+        out_wav,
+        media_type="audio/wav",
+        filename="final.wav",
+        stat_result=st,
+        headers={"ETag": etag},
+    )
\ No newline at end of file
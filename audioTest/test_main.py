@@ -0,0 +1,64 @@
+import asyncio, os, subprocess, wave
+import pytest
+import main
+
+pytestmark = pytest.mark.skipif(main.FFMPEG is None, reason="ffmpeg not found")
+
+def make_chunk(path, freq: int):
+    # ffmpeg 내장 인코더만으로 1초짜리 조각 생성 (ogg: flac, webm: opus)
+    codec = ["-c:a", "flac"] if path.suffix == ".ogg" else ["-c:a", "opus", "-strict", "-2", "-ar", "48000"]
+    subprocess.run([
+        main.FFMPEG, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"sine=frequency={freq}:duration=1",
+        "-ac", "1", *codec, str(path)
+    ], check=True)
+
+def make_session(monkeypatch, tmp_path, sid: str, exts: list):
+    monkeypatch.setattr(main, "SESS_BASE", tmp_path)
+    # 테스트마다 asyncio.run으로 새 루프를 쓰므로 모듈 세마포어도 새로 만듦
+    monkeypatch.setattr(main, "FFMPEG_SEM", asyncio.Semaphore(os.cpu_count() or 1))
+    d = main.sess_dir(sid)
+    for seq, ext in enumerate(exts, start=1):
+        make_chunk(d / main.chunk_name(seq, ext), 300 + seq * 100)
+    main.save_meta(sid, {"state": "ended", "start_seq": 1, "end_seq": len(exts)})
+    # 캐시를 비워 load_meta가 meta.json + scan_chunks로 복원하게 함
+    main.evict_meta(sid)
+    return d
+
+def wav_info(path):
+    with wave.open(str(path)) as w:
+        return w.getnchannels(), w.getframerate(), w.getnframes()
+
+def assert_seconds(path, seconds: int):
+    channels, rate, frames = wav_info(path)
+    assert (channels, rate) == (1, 16000)
+    assert abs(frames - seconds * 16000) < 1600
+
+def test_build_final_wav_single_pass(monkeypatch, tmp_path):
+    d = make_session(monkeypatch, tmp_path, "single", ["ogg", "ogg", "ogg"])
+
+    out_wav, skipped = asyncio.run(main.build_final_wav("single"))
+
+    # 단일 패스가 실패하면 폴백으로 넘어가 wav/가 생기므로 함께 확인
+    assert skipped == []
+    assert not (d / "wav").exists()
+    assert_seconds(out_wav, 3)
+
+def test_build_final_wav_mixed_containers(monkeypatch, tmp_path):
+    d = make_session(monkeypatch, tmp_path, "mixed", ["ogg", "webm", "ogg"])
+
+    out_wav, skipped = asyncio.run(main.build_final_wav("mixed"))
+
+    assert skipped == []
+    assert (d / "wav").is_dir()
+    assert_seconds(out_wav, 3)
+
+def test_build_final_wav_fallback_skips_broken_chunk(monkeypatch, tmp_path):
+    d = make_session(monkeypatch, tmp_path, "broken", ["ogg", "ogg", "ogg"])
+    # 첫 조각이 깨지면 단일 패스가 실패해 조각별 디코드로 넘어감
+    (d / main.chunk_name(1, "ogg")).write_bytes(b"not an ogg file")
+
+    out_wav, skipped = asyncio.run(main.build_final_wav("broken"))
+
+    assert [name for name, _ in skipped] == [main.chunk_name(1, "ogg")]
+    assert_seconds(out_wav, 2)
\ No newline at end of file
@@ -1,8 +1,11 @@
 from fastapi import FastAPI, UploadFile, Form, Response
 from fastapi.responses import JSONResponse
 from pathlib import Path
-from typing import Dict
-import shutil
+from collections import defaultdict
+from typing import DefaultDict
+from secrets import token_hex
+import shutil, os
+import aiofiles
 
 app = FastAPI()
 
@@ -13,7 +16,8 @@ INBOX = BASE / "inbox"        # (선택) 조각 저장용
 INBOX.mkdir(exist_ok=True)
 
 # 세션별 조각 카운트 (데모/메모리)
-session_counts: Dict[str, int] = {}
+# 증가와 읽기 사이에 await가 없으므로 이벤트 루프 안에서는 원자적
+session_counts: DefaultDict[str, int] = defaultdict(int)
 
 @app.post("/ingest-chunk")
 async def ingest_chunk(
@@ -31,8 +35,8 @@ async def ingest_chunk(
             shutil.copyfileobj(chunk.file, f)
 
         # 데모 : 2번째는 start, 8번째는 end
-        n = session_counts.get(sessionId, 0) + 1
-        session_counts[sessionId] = n
+        session_counts[sessionId] += 1
+        n = session_counts[sessionId]
 
         if n == 2:
             return {"decision": "start"}
@@ -54,13 +58,26 @@ async def ingest_final(
     Server A가 end를 받은 즉시 병합한 최종 WAV를 업로드.
     여기서 세션 폴더에 저장.
     """
+    # 세션 ID는 경로 한 칸이어야 함 ("../" 등으로 sessions_b 밖에 쓰지 않도록)
+    if sessionId in ("", ".", "..") or Path(sessionId).name != sessionId:
+        return JSONResponse({"saved": False, "detail": "invalid sessionId"}, status_code=400)
+
+    tmp_path = None
     try:
-        d = SESS_BASE
+        d = SESS_BASE / sessionId
+        d.mkdir(parents=True, exist_ok=True)
         out_path = d / "final.wav"
-        with out_path.open("wb") as f:
-            shutil.copyfileobj(final.file, f)
+        # 업로드마다 다른 임시 파일에 1MB씩 기록한 뒤 rename
+        # → 받는 도중의 파일이 보이지 않고, 같은 세션의 동시 업로드끼리 섞이지 않음
+        tmp_path = d / f"final.wav.{token_hex(8)}.part"
+        async with aiofiles.open(tmp_path, "wb") as f:
+            while data := await final.read(1 << 20):
+                await f.write(data)
+        os.replace(tmp_path, out_path)
 
         # 저장 완료
         return JSONResponse({"saved": True, "path": str(out_path)}, status_code=201)
     except Exception as e:
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
         return JSONResponse({"saved": False, "detail": str(e)}, status_code=500)
\ No newline at end of file